@@ -5,105 +5,461 @@ Converts a text file to speech using Fish.audio's API with your cloned voice mod
 """
 
 import os
-import time
 import re
-from fish_audio_sdk import Session, TTSRequest
+import sys
+import uuid
+import wave
+import argparse
+import shutil
+import mmap
+import math
+import time
+import json
+import hashlib
+import bisect
+import functools
+import itertools
+import asyncio
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+import aiofiles
+import ormsgpack
+import websockets
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, wait_exponential_jitter, stop_after_attempt
 
 # Configuration
+TTS_BACKEND = "fish"  # "fish" for Fish Audio's API, "local" for a Piper voice on this machine
+PIPER_MODEL_PATH = "voice.onnx"  # Piper voice model (with its .onnx.json config next to it) for the local backend
 API_KEY = "your_api_key_here"  # Replace with your actual API key
 MODEL_ID = "your_model_id_here"  # Replace with your cloned voice model ID
 INPUT_TEXT_FILE = "input.txt"  # Path to your text file
-OUTPUT_AUDIO_FILE = "output.wav"  # Output audio file name
+OUTPUT_AUDIO_FILE = "output.mp3"  # Output audio file name
+AUDIO_FORMAT = "mp3"  # MP3 frames can be concatenated chunk after chunk
+MP3_BITRATE = 64  # kbps; 64 is plenty for speech
 CHUNK_SIZE = 1800  # Characters per chunk (leaving buffer for safety)
+MAX_CONCURRENT_REQUESTS = 5  # Chunks synthesized in parallel
+MAX_REQUESTS_PER_SECOND = 5  # Upper bound for the adaptive request rate
+WRITE_QUEUE_SIZE = 8  # Finished chunks allowed to wait for the disk writer
+FISH_API_URL = "https://api.fish.audio"
+FISH_LIVE_URL = "wss://api.fish.audio/v1/tts/live"
+STREAM_TTS = False  # Stream text over a websocket for the fastest first audio (no concurrency or caching)
+TTS_CACHE_DIR = ".tts_cache"  # Synthesized chunks are kept here so re-runs skip them
+CACHE_VERSION = 1  # Bump to invalidate every cached chunk
+PARALLEL_SPLIT_THRESHOLD = 1_000_000  # Characters above which splitting runs on all CPU cores
+NUMBA_SPLIT_THRESHOLD = 1_000_000  # Characters above which ASCII texts are split by a numba kernel, if installed
+
+# Precompiled patterns used by clean_text_for_tts
+_CLEAN_RE = re.compile(r'[^\w\s\.\,\!\?\;\:\-\'\"]')  # Anything but basic punctuation
+_LONG_WORD_RE = re.compile(r'\S{51,}')  # Extremely long words
+_WS_RE = re.compile(r'\s+')
+
+# str.translate table with the same effect as _CLEAN_RE on ASCII text
+_ASCII_CLEAN_TABLE = {code_point: ' ' for code_point in range(128) if _CLEAN_RE.match(chr(code_point))}
 
 def clean_text_for_tts(text):
     """
     Clean and prepare text for better TTS output
     """
-    # Remove or replace problematic characters
-    text = re.sub(r'[^\w\s\.\,\!\?\;\:\-\'\"]', ' ', text)  # Keep basic punctuation
-    
-    # Fix multiple spaces
-    text = re.sub(r'\s+', ' ', text)
+    # Remove or replace problematic characters. str.translate only beats the
+    # regex on pure-ASCII text; a single curly quote makes it slower
+    if text.isascii():
+        text = text.translate(_ASCII_CLEAN_TABLE)
+    else:
+        text = _CLEAN_RE.sub(' ', text)
     
     # Remove very long words that might cause issues
-    words = text.split()
-    cleaned_words = []
-    for word in words:
-        if len(word) > 50:  # Skip extremely long words
-            continue
-        cleaned_words.append(word)
-    
-    text = ' '.join(cleaned_words)
+    text = _LONG_WORD_RE.sub('', text)
+    
+    # Fix multiple spaces
+    text = _WS_RE.sub(' ', text)
     return text.strip()
 
-def smart_text_splitter(text, chunk_size=1800):
+_SENTENCE_ENDINGS = ('. ', '! ', '? ')  # After cleaning, all whitespace is a single space
+
+def _find_nearest(text, separators, start, target, end):
     """
-    Split text intelligently at sentence boundaries to avoid cutting words mid-sentence
+    Return the position of the separator occurrence nearest `target` that lies
+    entirely within text[start:end], or -1 if there is none
     """
-    # Clean the text first
-    text = clean_text_for_tts(text)
+    before = max(text.rfind(separator, start, min(target + len(separator), end)) for separator in separators)
+    after = [position for position in (text.find(separator, target, end) for separator in separators)
+             if position != -1]
     
-    if len(text) <= chunk_size:
-        return [text]
-    
-    chunks = []
+    candidates = ([before] if before != -1 else []) + ([min(after)] if after else [])
+    return min(candidates, key=lambda position: abs(position - target), default=-1)
+
+def _split_points(text, chunk_size):
+    """
+    Yield the (start, end) offsets of each chunk of a cleaned text
+    """
     current_pos = 0
     
-    while current_pos < len(text):
-        # Get the chunk
+    while len(text) - current_pos > chunk_size:
+        # Aim for equal-sized chunks over whatever is left instead of filling each
+        # one greedily, so the book doesn't end on a tiny straggler chunk
+        remaining = len(text) - current_pos
+        target = current_pos + remaining // math.ceil(remaining / chunk_size)
         end_pos = current_pos + chunk_size
         
-        if end_pos >= len(text):
-            # Last chunk
-            chunks.append(text[current_pos:].strip())
-            break
-        
-        # Find the best place to split (sentence boundary)
-        chunk_text = text[current_pos:end_pos]
-        
-        # Look for sentence endings working backwards from the end
-        sentence_endings = ['. ', '! ', '? ', '.\n', '!\n', '?\n']
-        best_split = -1
-        
-        for i in range(len(chunk_text)-1, max(len(chunk_text)//2, 0), -1):
-            for ending in sentence_endings:
-                if chunk_text[i:i+len(ending)] == ending:
-                    best_split = i + 1  # Include the period/punctuation
-                    break
-            if best_split != -1:
-                break
-        
-        if best_split == -1:
-            # No sentence boundary found, split at word boundary
-            words = chunk_text.split()
-            if len(words) > 1:
-                # Take all but the last word to avoid cutting mid-word
-                chunk_text = ' '.join(words[:-1])
-                best_split = len(chunk_text)
-            else:
+        # Find the best place to split: the sentence ending nearest the target
+        # that fits in this chunk and leaves it at least half its target size.
+        # Only the text around each cut is scanned, with plain substring search
+        ending = _find_nearest(text, _SENTENCE_ENDINGS, (current_pos + target) // 2, target, end_pos + 1)
+        
+        if ending != -1:
+            split_pos = ending + 1  # Include the period/punctuation
+        else:
+            # No sentence boundary found, split at the word boundary nearest the target
+            split_pos = _find_nearest(text, (' ',), current_pos + 1, target, end_pos + 1)
+            if split_pos == -1:
                 # Single very long word, just cut it
-                best_split = chunk_size
+                split_pos = end_pos
         
-        chunks.append(text[current_pos:current_pos + best_split].strip())
-        current_pos += best_split
+        yield current_pos, split_pos
+        current_pos = split_pos
         
         # Skip any whitespace at the beginning of next chunk
         while current_pos < len(text) and text[current_pos].isspace():
             current_pos += 1
     
-    return [chunk for chunk in chunks if chunk.strip()]
+    # Last chunk
+    yield current_pos, len(text)
+
+def _find_nearest_ascii(buf, sentence_ending, start, target, end):
+    """
+    numba-compiled twin of _find_nearest for _SENTENCE_ENDINGS (sentence_ending=True)
+    or a single space: scan outwards from the target, earlier position first on ties
+    """
+    length = 2 if sentence_ending else 1
+    last = end - length
+    distance = 0
+    while target - distance >= start or target + distance <= last:
+        for position in (target - distance, target + distance):
+            if start <= position <= last:
+                byte = buf[position]
+                if sentence_ending:
+                    if (byte == 46 or byte == 33 or byte == 63) and buf[position + 1] == 32:
+                        return position
+                elif byte == 32:
+                    return position
+        distance += 1
+    return -1
+
+def _split_points_ascii(buf, chunk_size):
+    """
+    numba-compiled twin of _split_points for ASCII text given as a uint8 array;
+    returns a flat array of start/end offset pairs
+    """
+    points = [0]
+    points.pop()
+    current_pos = 0
+    
+    while len(buf) - current_pos > chunk_size:
+        remaining = len(buf) - current_pos
+        target = current_pos + remaining // ((remaining + chunk_size - 1) // chunk_size)
+        end_pos = current_pos + chunk_size
+        
+        split_pos = _find_nearest_ascii(buf, True, (current_pos + target) // 2, target, end_pos + 1)
+        if split_pos != -1:
+            split_pos += 1
+        else:
+            split_pos = _find_nearest_ascii(buf, False, current_pos + 1, target, end_pos + 1)
+            if split_pos == -1:
+                split_pos = end_pos
+        
+        points.append(current_pos)
+        points.append(split_pos)
+        current_pos = split_pos
+        
+        while current_pos < len(buf) and (buf[current_pos] == 32 or 9 <= buf[current_pos] <= 13):
+            current_pos += 1
+    
+    points.append(current_pos)
+    points.append(len(buf))
+    return np.array(points, dtype=np.int64)
+
+# numba is optional and slow to import and compile, so the ASCII kernel is
+# only loaded the first time a text large enough to benefit comes along
+np = None
+_ascii_kernel = None
+
+def _load_ascii_kernel():
+    """
+    Compile the ASCII split kernel with numba on first use; returns None when numba isn't installed
+    """
+    global np, _find_nearest_ascii, _ascii_kernel
+    
+    if _ascii_kernel is None:
+        try:
+            import numpy
+            from numba import njit
+        except ImportError:
+            _ascii_kernel = False
+        else:
+            np = numpy
+            # The kernel looks its helper up by global name when it is compiled
+            _find_nearest_ascii = njit(cache=True)(_find_nearest_ascii)
+            _ascii_kernel = njit(cache=True)(_split_points_ascii)
+    
+    return _ascii_kernel or None
+
+def iter_text_chunks(text, chunk_size=1800, already_clean=False):
+    """
+    Yield the non-empty chunks of a text one at a time, as soon as each split point is found
+    """
+    if not already_clean:
+        text = clean_text_for_tts(text)
+    
+    if len(text) <= chunk_size:
+        if text:
+            yield text
+        return
+    
+    # ASCII text has one byte per character, so the compiled kernel's byte
+    # offsets can slice the string directly
+    kernel = None
+    if len(text) > NUMBA_SPLIT_THRESHOLD and text.isascii():
+        kernel = _load_ascii_kernel()
+    
+    if kernel is not None:
+        buf = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+        points = kernel(buf, chunk_size).reshape(-1, 2).tolist()
+    else:
+        points = _split_points(text, chunk_size)
+    
+    for start, end in points:
+        piece = text[start:end].strip()
+        if piece:
+            yield piece
+
+def smart_text_splitter(text, chunk_size=1800, already_clean=False):
+    """
+    Split text intelligently at sentence boundaries to avoid cutting words mid-sentence.
+    Pass already_clean=True when the text has been through clean_text_for_tts
+    """
+    return list(iter_text_chunks(text, chunk_size, already_clean))
+
+def create_fish_client(api_key, max_connections=MAX_CONCURRENT_REQUESTS):
+    """
+    Create an HTTP/2 client whose connections are kept alive and reused across every TTS request
+    """
+    return httpx.AsyncClient(
+        base_url=FISH_API_URL,
+        http2=True,
+        headers={"Authorization": f"Bearer {api_key}"},
+        limits=httpx.Limits(max_keepalive_connections=max_connections),
+        timeout=120
+    )
+
+class RateLimitError(Exception):
+    """Raised when Fish Audio answers with HTTP 429 or a 5xx error"""
+
+class AdaptiveRateLimiter:
+    """
+    Request rate limiter that halves its rate when the API pushes back and
+    adds one request per second back after a minute without pushback (AIMD)
+    """
+    
+    def __init__(self, max_rate, recovery_period=60.0):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.recovery_period = recovery_period
+        self._limiter = AsyncLimiter(max_rate, 1.0)
+        self._last_change = time.monotonic()
+        self._last_backoff = -math.inf
+    
+    async def acquire(self):
+        await self._limiter.acquire()
+    
+    def record_success(self):
+        if self.rate < self.max_rate and time.monotonic() - self._last_change >= self.recovery_period:
+            self._set_rate(self.rate + 1)
+    
+    def record_rate_limited(self):
+        # Requests already in flight when the API pushed back will report it too;
+        # only back off once per second so a single burst doesn't floor the rate
+        now = time.monotonic()
+        if now - self._last_backoff >= 1.0:
+            self._last_backoff = now
+            self._set_rate(max(1, self.rate // 2))
+    
+    def _set_rate(self, rate):
+        self.rate = rate
+        self._limiter = AsyncLimiter(rate, 1.0)
+        self._last_change = time.monotonic()
 
-def convert_large_text_to_speech(api_key, model_id, text_file_path, output_file_path, chunk_size=1800):
+def build_tts_payload(text, model_id):
     """
-    Convert a large text file to speech by splitting it into smart chunks
+    Build the JSON body of a Fish Audio TTS request
+    """
+    return {"text": text, "reference_id": model_id, "format": AUDIO_FORMAT, "mp3_bitrate": MP3_BITRATE}
+
+def tts_cache_path(payload):
     """
+    Return the cache file for a TTS request, addressed by a hash of everything that shapes its audio
+    """
+    preimage = json.dumps({"cache_version": CACHE_VERSION, **payload}, sort_keys=True).encode('utf-8')
+    key = hashlib.sha256(preimage).hexdigest()
+    return Path(TTS_CACHE_DIR) / key[:2] / key
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_exponential_jitter(1, 30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def request_chunk_audio(client, limiter, payload, cache_path):
+    """
+    Synthesize a single chunk straight into its cache file, backing off and
+    retrying while the API is rate limiting
+    """
+    await limiter.acquire()
+    
+    # Stream into a uniquely named part file and only move it into place once
+    # complete, so an interrupted run never leaves a truncated cache entry
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.part")
+    
     try:
-        session = Session(api_key)
+        async with client.stream("POST", "/v1/tts", json=payload) as response:
+            if response.status_code == 429 or response.status_code >= 500:
+                limiter.record_rate_limited()
+                raise RateLimitError(f"Fish Audio returned HTTP {response.status_code}")
+            response.raise_for_status()
+            async with aiofiles.open(part_path, "wb") as part_file:
+                async for audio_piece in response.aiter_bytes(65536):
+                    await part_file.write(audio_piece)
+        
+        os.replace(part_path, cache_path)
+    finally:
+        part_path.unlink(missing_ok=True)
+    
+    limiter.record_success()
+
+def parallel_text_splitter(text, chunk_size=1800, workers=None):
+    """
+    Split a very large text by sharding it at paragraph breaks and running
+    smart_text_splitter on each shard in its own process. The text must not be
+    cleaned yet: cleaning removes the paragraph breaks, so each worker cleans its own shard
+    """
+    workers = workers or os.cpu_count() or 1
+    paragraphs = text.split('\n\n')
+    
+    # Group paragraphs into shards of roughly equal length using their running total
+    ends = list(itertools.accumulate(len(paragraph) + 2 for paragraph in paragraphs))
+    cuts = [bisect.bisect_left(ends, ends[-1] * i / workers) + 1 for i in range(1, workers)]
+    shards = ['\n\n'.join(paragraphs[start:end]) for start, end in zip([0] + cuts, cuts + [len(paragraphs)])]
+    shards = [shard for shard in shards if shard.strip()]
+    
+    # A single shard gains nothing from a worker process, only pickling overhead
+    if len(shards) <= 1:
+        return smart_text_splitter(text, chunk_size)
+    
+    with ProcessPoolExecutor(workers) as executor:
+        shard_chunks = executor.map(functools.partial(smart_text_splitter, chunk_size=chunk_size), shards)
+        return [chunk for chunks in shard_chunks for chunk in chunks]
+
+async def synthesize_chunk(client, semaphore, limiter, model_id, chunk, index, total):
+    """
+    Send a single chunk to Fish Audio's TTS endpoint (unless its audio is
+    already cached) and return the path of its audio file, or None if it failed
+    """
+    payload = build_tts_payload(chunk, model_id)
+    cache_path = tts_cache_path(payload)
+    
+    if cache_path.exists():
+        print(f"♻️  Chunk {index + 1}/{total} loaded from cache ({cache_path.stat().st_size:,} bytes)")
+        return cache_path
+    
+    async with semaphore:
+        print(f"\n🎵 Processing chunk {index + 1}/{total} ({len(chunk)} chars)")
+        print(f"Preview: {chunk[:100]}...")
+        
+        try:
+            await request_chunk_audio(client, limiter, payload, cache_path)
+            print(f"✅ Chunk {index + 1} completed ({cache_path.stat().st_size:,} bytes)")
+            return cache_path
+            
+        except Exception as e:
+            print(f"❌ Error processing chunk {index + 1}: {str(e)}")
+            print("⏩ Skipping this chunk and continuing...")
+            return None
+
+async def synthesize_in_order(client, semaphore, limiter, queue, model_id, chunks, lookahead):
+    """
+    Synthesize chunks concurrently, never running more than `lookahead` chunks
+    ahead of the oldest unfinished one, and queue their audio files in chunk order
+    """
+    pending = deque()
+    
+    try:
+        for i, chunk in enumerate(chunks):
+            pending.append(asyncio.create_task(
+                synthesize_chunk(client, semaphore, limiter, model_id, chunk, i, len(chunks))
+            ))
+            
+            # Hand finished chunks to the writer once the window is full, and all of them at the end
+            while pending and (len(pending) >= lookahead or i == len(chunks) - 1):
+                audio_path = await pending.popleft()
+                if audio_path is not None:
+                    await queue.put(audio_path)
+    finally:
+        # If the writer failed we are cancelled; don't leave chunks synthesizing in the background
+        for task in pending:
+            task.cancel()
+    
+    # Tell the writer there is nothing more to come
+    await queue.put(None)
+
+def append_audio_file(destination, source_path):
+    """
+    Append a file to an open (unbuffered) destination file and return the
+    number of bytes copied. On Linux the copy happens in the kernel
+    """
+    with open(source_path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        
+        if sys.platform.startswith('linux'):
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(destination.fileno(), source.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return offset
         
-        # Read the entire text file
-        with open(text_file_path, 'r', encoding='utf-8') as file:
-            full_text = file.read().strip()
+        # Other platforms' sendfile only writes to sockets
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+        return size
+
+async def audio_writer(queue, output_file_path):
+    """
+    Append queued chunk audio files to the output file until the end-of-stream marker arrives
+    """
+    written_chunks = 0
+    total_size = 0
+    
+    with open(output_file_path, "wb", buffering=0) as final_audio:
+        while (audio_path := await queue.get()) is not None:
+            total_size += await asyncio.to_thread(append_audio_file, final_audio, audio_path)
+            written_chunks += 1
+    
+    return written_chunks, total_size
+
+async def convert_large_text_to_speech(api_key, model_id, text_data, output_file_path, chunk_size=1800,
+                                       max_concurrent=MAX_CONCURRENT_REQUESTS):
+    """
+    Convert a large text (UTF-8 bytes or a memory-mapped file) to speech by
+    splitting it into smart chunks and synthesizing up to `max_concurrent`
+    chunks at a time
+    """
+    try:
+        # Decode straight from the buffer, without an intermediate bytes copy
+        full_text = str(text_data, 'utf-8').strip()
         
         if not full_text:
             print("Error: Text file is empty!")
@@ -111,338 +467,204 @@ def convert_large_text_to_speech(api_key, model_id, text_file_path, output_file_
         
         print(f"📖 Full text length: {len(full_text):,} characters")
         
-        # Split text into smart chunks
-        chunks = smart_text_splitter(full_text, chunk_size)
+        # Split text into smart chunks, spreading the work over all cores for huge books
+        if len(full_text) > PARALLEL_SPLIT_THRESHOLD:
+            chunks = parallel_text_splitter(full_text, chunk_size)
+        else:
+            text = clean_text_for_tts(full_text)
+            chunks = smart_text_splitter(text, chunk_size, already_clean=True)
+        
+        if not chunks:
+            print("Error: No speakable text left after cleaning!")
+            return False
         
         print(f"🔄 Split into {len(chunks)} chunks")
         print(f"📊 Average chunk size: {sum(len(chunk) for chunk in chunks) // len(chunks)} characters")
         
-        # Process each chunk and combine audio
-        audio_chunks = []
-        
-        for i, chunk in enumerate(chunks, 1):
-            print(f"\n🎵 Processing chunk {i}/{len(chunks)} ({len(chunk)} chars)")
-            print(f"Preview: {chunk[:100]}...")
-            
-            try:
-                tts_request = TTSRequest(
-                    text=chunk,
-                    reference_id=model_id
-                )
-                
-                chunk_audio = b''
-                for audio_piece in session.tts(tts_request):
-                    chunk_audio += audio_piece
-                
-                audio_chunks.append(chunk_audio)
-                print(f"✅ Chunk {i} completed ({len(chunk_audio):,} bytes)")
-                
-                # Small delay to be nice to the API
-                if i < len(chunks):
-                    time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"❌ Error processing chunk {i}: {str(e)}")
-                print("⏩ Skipping this chunk and continuing...")
-                continue
+        # Process chunks concurrently; the semaphore bounds requests in flight
+        # and the limiter adapts the request rate to the API's pushback, while
+        # the writer appends finished chunks to disk in order. The bounded queue
+        # holds synthesis back whenever the disk falls behind
+        semaphore = asyncio.Semaphore(max_concurrent)
+        limiter = AdaptiveRateLimiter(MAX_REQUESTS_PER_SECOND)
+        queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
         
-        # Combine all audio chunks into final file
-        print(f"\n🔗 Combining {len(audio_chunks)} audio chunks...")
+        # Run synthesis and the writer as one group, so if either fails the
+        # other is cancelled instead of waiting on the queue forever
+        async with create_fish_client(api_key, max_concurrent) as client, asyncio.TaskGroup() as group:
+            writer_task = group.create_task(audio_writer(queue, output_file_path))
+            group.create_task(synthesize_in_order(client, semaphore, limiter, queue, model_id, chunks,
+                                                  lookahead=2 * max_concurrent))
         
-        with open(output_file_path, "wb") as final_audio:
-            for audio_chunk in audio_chunks:
-                final_audio.write(audio_chunk)
+        written_chunks, total_size = writer_task.result()
         
-        total_size = sum(len(chunk) for chunk in audio_chunks)
         print(f"✅ Large text conversion completed!")
         print(f"📁 Audio saved to: {output_file_path}")
         print(f"📊 Final audio size: {total_size:,} bytes")
-        print(f"🎯 Successfully processed {len(audio_chunks)}/{len(chunks)} chunks")
+        print(f"🎯 Successfully processed {written_chunks}/{len(chunks)} chunks")
         
         return True
         
-    except FileNotFoundError:
-        print(f"❌ Error: Text file '{text_file_path}' not found!")
+    except ExceptionGroup as group:
+        print(f"❌ Error during large text conversion: {str(group.exceptions[0])}")
         return False
     except Exception as e:
         print(f"❌ Error during large text conversion: {str(e)}")
         return False
 
-def convert_text_file_to_speech(api_key, model_id, text_file_path, output_file_path):
+async def send_text_stream(websocket, model_id, text, chunk_size):
     """
-    Convert a small text file to speech using Fish Audio TTS API
+    Feed text chunks to the live TTS websocket as the splitter produces them
+    """
+    sent_chunks = 0
+    
+    await websocket.send(ormsgpack.packb({"event": "start", "request": build_tts_payload("", model_id)}))
+    
+    for chunk in iter_text_chunks(text, chunk_size):
+        await websocket.send(ormsgpack.packb({"event": "text", "text": chunk + " "}))
+        sent_chunks += 1
+    
+    await websocket.send(ormsgpack.packb({"event": "stop"}))
+    return sent_chunks
+
+async def stream_text_to_speech(api_key, model_id, text_data, output_file_path, chunk_size=1800):
+    """
+    Convert a text (UTF-8 bytes or a memory-mapped file) to speech over Fish
+    Audio's live websocket, sending text while audio for earlier text is
+    already coming back and being written
     """
     try:
-        session = Session(api_key)
-        
-        with open(text_file_path, 'r', encoding='utf-8') as file:
-            text_content = file.read().strip()
+        full_text = str(text_data, 'utf-8').strip()
         
-        if not text_content:
+        if not full_text:
             print("Error: Text file is empty!")
             return False
         
-        # Clean the text
-        text_content = clean_text_for_tts(text_content)
+        print(f"📖 Full text length: {len(full_text):,} characters")
         
-        print(f"Converting text from '{text_file_path}' to speech...")
-        print(f"Text length: {len(text_content)} characters")
-        print(f"Using model ID: {model_id}")
+        total_size = 0
+        finished = False
+        headers = {"Authorization": f"Bearer {api_key}"}
         
-        tts_request = TTSRequest(
-            text=text_content,
-            reference_id=model_id
-        )
+        async with websockets.connect(FISH_LIVE_URL, additional_headers=headers, max_size=None) as websocket:
+            sender_task = asyncio.create_task(send_text_stream(websocket, model_id, full_text, chunk_size))
+            
+            try:
+                async with aiofiles.open(output_file_path, "wb") as audio_file:
+                    async for message in websocket:
+                        event = ormsgpack.unpackb(message)
+                        
+                        if event["event"] == "audio":
+                            if total_size == 0:
+                                print(f"🎧 First audio received, streaming to {output_file_path}...")
+                            await audio_file.write(event["audio"])
+                            total_size += len(event["audio"])
+                        elif event["event"] == "finish":
+                            if event.get("reason") == "error":
+                                raise RuntimeError("Fish Audio reported an error while streaming")
+                            finished = True
+                            break
+                
+                # A socket closed without a finish event means the audio is truncated
+                if not finished:
+                    raise RuntimeError("Connection closed before Fish Audio finished streaming")
+                
+                sent_chunks = await sender_task
+            finally:
+                sender_task.cancel()
         
-        with open(output_file_path, "wb") as audio_file:
-            for chunk in session.tts(tts_request):
-                audio_file.write(chunk)
+        print(f"✅ Streaming conversion completed!")
+        print(f"📁 Audio saved to: {output_file_path}")
+        print(f"📊 Final audio size: {total_size:,} bytes")
+        print(f"🎯 Streamed {sent_chunks} text chunks")
         
-        print(f"✅ Speech generation completed!")
-        print(f"Audio saved to: {output_file_path}")
         return True
         
-    except FileNotFoundError:
-        print(f"❌ Error: Text file '{text_file_path}' not found!")
-        return False
     except Exception as e:
-        print(f"❌ Error during speech generation: {str(e)}")
+        print(f"❌ Error during streaming conversion: {str(e)}")
         return False
 
-def main():
-    """Main function to run the TTS conversion"""
-    
-    # Check if configuration is set
-    if API_KEY == "your_api_key_here" or MODEL_ID == "your_model_id_here":
-        print("⚠️  Please update the configuration section with your actual API key and model ID!")
-        return
-    
-    # Check if input file exists
-    if not os.path.exists(INPUT_TEXT_FILE):
-        print(f"⚠️  Input file '{INPUT_TEXT_FILE}' not found!")
-        print("Please make sure your text file exists and update the INPUT_TEXT_FILE path.")
-        return
-    
-    # Check file size to determine approach
-    with open(INPUT_TEXT_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    text_length = len(content)
-    print(f"📄 Text file size: {text_length:,} characters")
-    
-    if text_length > 2000:
-        print(f"📚 Large file detected! Using smart chunking approach...")
-        success = convert_large_text_to_speech(
-            api_key=API_KEY,
-            model_id=MODEL_ID,
-            text_file_path=INPUT_TEXT_FILE,
-            output_file_path=OUTPUT_AUDIO_FILE,
-            chunk_size=CHUNK_SIZE
-        )
-    else:
-        print(f"📝 Small file, using standard conversion...")
-        success = convert_text_file_to_speech(
-            api_key=API_KEY,
-            model_id=MODEL_ID,
-            text_file_path=INPUT_TEXT_FILE,
-            output_file_path=OUTPUT_AUDIO_FILE
-        )
-    
-    if success:
-        print(f"\n🎉 Your text has been successfully converted to speech!")
-        print(f"🎧 You can now play the audio file: {OUTPUT_AUDIO_FILE}")
-        print(f"⏱️  For 100K+ characters, this process may take several minutes...")
-    else:
-        print(f"\n❌ Conversion failed. Check the error messages above.")
-
-if __name__ == "__main__":
-    # First, install the required package if not already installed
-    try:
-        import fish_audio_sdk
-    except ImportError:
-        print("Installing Fish Audio SDK...")
-        os.system("pip install fish-audio-sdk")
-        import fish_audio_sdk
-    
-    main()#!/usr/bin/env python3
-"""
-Fish Audio Text-to-Speech Converter
-Converts a text file to speech using Fish.audio's API with your cloned voice model.
-"""
-
-import os
-import time
-import re
-from fish_audio_sdk import Session, TTSRequest
-
-# Configuration
-API_KEY = "your_api_key_here"  # Replace with your actual API key
-MODEL_ID = "your_model_id_here"  # Replace with your cloned voice model ID
-INPUT_TEXT_FILE = "input.txt"  # Path to your text file
-OUTPUT_AUDIO_FILE = "output.wav"  # Output audio file name
-CHUNK_SIZE = 1800  # Characters per chunk (leaving buffer for safety)
-
-def clean_text_for_tts(text):
+async def feed_piper(process, text, chunk_size):
     """
-    Clean and prepare text for better TTS output
+    Write text chunks to piper's stdin, one utterance per line, then close it
     """
-    # Remove or replace problematic characters
-    text = re.sub(r'[^\w\s\.\,\!\?\;\:\-\'\"]', ' ', text)  # Keep basic punctuation
+    sent_chunks = 0
     
-    # Fix multiple spaces
-    text = re.sub(r'\s+', ' ', text)
+    for chunk in iter_text_chunks(text, chunk_size):
+        process.stdin.write(chunk.encode('utf-8') + b"\n")
+        await process.stdin.drain()
+        sent_chunks += 1
     
-    # Remove very long words that might cause issues
-    words = text.split()
-    cleaned_words = []
-    for word in words:
-        if len(word) > 50:  # Skip extremely long words
-            continue
-        cleaned_words.append(word)
-    
-    text = ' '.join(cleaned_words)
-    return text.strip()
+    process.stdin.close()
+    return sent_chunks
 
-def smart_text_splitter(text, chunk_size=1800):
+async def convert_text_with_piper(model_path, text_data, output_file_path, chunk_size=1800):
     """
-    Split text intelligently at sentence boundaries to avoid cutting words mid-sentence
+    Convert a text (UTF-8 bytes or a memory-mapped file) to speech with a local
+    Piper voice. A single piper process loads the model once, reads every chunk
+    and streams raw PCM back, which is written to a WAV file as it arrives
     """
-    # Clean the text first
-    text = clean_text_for_tts(text)
-    
-    if len(text) <= chunk_size:
-        return [text]
+    process = None
     
-    chunks = []
-    current_pos = 0
-    
-    while current_pos < len(text):
-        # Get the chunk
-        end_pos = current_pos + chunk_size
-        
-        if end_pos >= len(text):
-            # Last chunk
-            chunks.append(text[current_pos:].strip())
-            break
-        
-        # Find the best place to split (sentence boundary)
-        chunk_text = text[current_pos:end_pos]
-        
-        # Look for sentence endings working backwards from the end
-        sentence_endings = ['. ', '! ', '? ', '.\n', '!\n', '?\n']
-        best_split = -1
-        
-        for i in range(len(chunk_text)-1, max(len(chunk_text)//2, 0), -1):
-            for ending in sentence_endings:
-                if chunk_text[i:i+len(ending)] == ending:
-                    best_split = i + 1  # Include the period/punctuation
-                    break
-            if best_split != -1:
-                break
-        
-        if best_split == -1:
-            # No sentence boundary found, split at word boundary
-            words = chunk_text.split()
-            if len(words) > 1:
-                # Take all but the last word to avoid cutting mid-word
-                chunk_text = ' '.join(words[:-1])
-                best_split = len(chunk_text)
-            else:
-                # Single very long word, just cut it
-                best_split = chunk_size
-        
-        chunks.append(text[current_pos:current_pos + best_split].strip())
-        current_pos += best_split
-        
-        # Skip any whitespace at the beginning of next chunk
-        while current_pos < len(text) and text[current_pos].isspace():
-            current_pos += 1
-    
-    return [chunk for chunk in chunks if chunk.strip()]
-
-def convert_large_text_to_speech(api_key, model_id, text_file_path, output_file_path, chunk_size=1800):
-    """
-    Convert a large text file to speech by splitting it into smart chunks
-    """
     try:
-        session = Session(api_key)
-        
-        # Read the entire text file
-        with open(text_file_path, 'r', encoding='utf-8') as file:
-            full_text = file.read().strip()
+        full_text = str(text_data, 'utf-8').strip()
         
         if not full_text:
             print("Error: Text file is empty!")
             return False
         
         print(f"📖 Full text length: {len(full_text):,} characters")
+        print(f"Using Piper voice: {model_path}")
         
-        # Split text into smart chunks
-        chunks = smart_text_splitter(full_text, chunk_size)
-        
-        print(f"🔄 Split into {len(chunks)} chunks")
-        print(f"📊 Average chunk size: {sum(len(chunk) for chunk in chunks) // len(chunks)} characters")
-        
-        # Process each chunk and combine audio
-        audio_chunks = []
+        with open(f"{model_path}.json", 'r', encoding='utf-8') as config_file:
+            sample_rate = json.load(config_file)["audio"]["sample_rate"]
         
-        for i, chunk in enumerate(chunks, 1):
-            print(f"\n🎵 Processing chunk {i}/{len(chunks)} ({len(chunk)} chars)")
-            print(f"Preview: {chunk[:100]}...")
+        process = await asyncio.create_subprocess_exec(
+            "piper", "--model", model_path, "--output-raw",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+        feeder_task = asyncio.create_task(feed_piper(process, full_text, chunk_size))
+        
+        total_size = 0
+        # Piper's raw output is 16-bit mono PCM at the voice's sample rate
+        with wave.open(output_file_path, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
             
-            try:
-                tts_request = TTSRequest(
-                    text=chunk,
-                    reference_id=model_id
-                )
-                
-                chunk_audio = b''
-                for audio_piece in session.tts(tts_request):
-                    chunk_audio += audio_piece
-                
-                audio_chunks.append(chunk_audio)
-                print(f"✅ Chunk {i} completed ({len(chunk_audio):,} bytes)")
-                
-                # Small delay to be nice to the API
-                if i < len(chunks):
-                    time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"❌ Error processing chunk {i}: {str(e)}")
-                print("⏩ Skipping this chunk and continuing...")
-                continue
+            while audio_piece := await process.stdout.read(65536):
+                wav_file.writeframesraw(audio_piece)
+                total_size += len(audio_piece)
         
-        # Combine all audio chunks into final file
-        print(f"\n🔗 Combining {len(audio_chunks)} audio chunks...")
+        sent_chunks = await feeder_task
+        if await process.wait() != 0:
+            raise RuntimeError(f"piper exited with code {process.returncode}")
         
-        with open(output_file_path, "wb") as final_audio:
-            for audio_chunk in audio_chunks:
-                final_audio.write(audio_chunk)
-        
-        total_size = sum(len(chunk) for chunk in audio_chunks)
-        print(f"✅ Large text conversion completed!")
+        print(f"✅ Local conversion completed!")
         print(f"📁 Audio saved to: {output_file_path}")
         print(f"📊 Final audio size: {total_size:,} bytes")
-        print(f"🎯 Successfully processed {len(audio_chunks)}/{len(chunks)} chunks")
+        print(f"🎯 Successfully processed {sent_chunks} chunks")
         
         return True
         
-    except FileNotFoundError:
-        print(f"❌ Error: Text file '{text_file_path}' not found!")
+    except FileNotFoundError as e:
+        print(f"❌ Error: {e.filename} not found! Is Piper installed and the voice model downloaded?")
         return False
     except Exception as e:
-        print(f"❌ Error during large text conversion: {str(e)}")
+        print(f"❌ Error during local conversion: {str(e)}")
         return False
+    finally:
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
 
-def convert_text_file_to_speech(api_key, model_id, text_file_path, output_file_path):
+async def convert_text_file_to_speech(api_key, model_id, text_data, output_file_path):
     """
-    Convert a small text file to speech using Fish Audio TTS API
+    Convert a small text (UTF-8 bytes or a memory-mapped file) to speech using Fish Audio TTS API
     """
     try:
-        session = Session(api_key)
-        
-        with open(text_file_path, 'r', encoding='utf-8') as file:
-            text_content = file.read().strip()
+        text_content = str(text_data, 'utf-8').strip()
         
         if not text_content:
             print("Error: Text file is empty!")
@@ -451,26 +673,24 @@ def convert_text_file_to_speech(api_key, model_id, text_file_path, output_file_p
         # Clean the text
         text_content = clean_text_for_tts(text_content)
         
-        print(f"Converting text from '{text_file_path}' to speech...")
+        print(f"Converting text to speech...")
         print(f"Text length: {len(text_content)} characters")
         print(f"Using model ID: {model_id}")
         
-        tts_request = TTSRequest(
-            text=text_content,
-            reference_id=model_id
-        )
-        
-        with open(output_file_path, "wb") as audio_file:
-            for chunk in session.tts(tts_request):
-                audio_file.write(chunk)
+        async with create_fish_client(api_key, 1) as client, \
+                aiofiles.open(output_file_path, "wb") as audio_file:
+            async with client.stream(
+                "POST", "/v1/tts",
+                json=build_tts_payload(text_content, model_id)
+            ) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(65536):
+                    await audio_file.write(chunk)
         
         print(f"✅ Speech generation completed!")
         print(f"Audio saved to: {output_file_path}")
         return True
         
-    except FileNotFoundError:
-        print(f"❌ Error: Text file '{text_file_path}' not found!")
-        return False
     except Exception as e:
         print(f"❌ Error during speech generation: {str(e)}")
         return False
@@ -478,56 +698,92 @@ def convert_text_file_to_speech(api_key, model_id, text_file_path, output_file_p
 def main():
     """Main function to run the TTS conversion"""
     
+    parser = argparse.ArgumentParser(description="Convert a text file to speech")
+    parser.add_argument("--backend", choices=["fish", "local"], default=TTS_BACKEND,
+                        help="'fish' for Fish Audio's API, 'local' for a Piper voice on this machine")
+    args = parser.parse_args()
+    
     # Check if configuration is set
-    if API_KEY == "your_api_key_here" or MODEL_ID == "your_model_id_here":
+    if args.backend == "fish" and (API_KEY == "your_api_key_here" or MODEL_ID == "your_model_id_here"):
         print("⚠️  Please update the configuration section with your actual API key and model ID!")
         return
     
+    if args.backend == "local" and not os.path.exists(PIPER_MODEL_PATH):
+        print(f"⚠️  Piper voice model '{PIPER_MODEL_PATH}' not found!")
+        print("Please download a Piper voice and update the PIPER_MODEL_PATH setting.")
+        return
+    
+    # Piper produces PCM, which is saved as WAV rather than MP3
+    if args.backend == "local":
+        output_file_path = os.path.splitext(OUTPUT_AUDIO_FILE)[0] + ".wav"
+    else:
+        output_file_path = OUTPUT_AUDIO_FILE
+    
     # Check if input file exists
     if not os.path.exists(INPUT_TEXT_FILE):
         print(f"⚠️  Input file '{INPUT_TEXT_FILE}' not found!")
         print("Please make sure your text file exists and update the INPUT_TEXT_FILE path.")
         return
     
-    # Check file size to determine approach
-    with open(INPUT_TEXT_FILE, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    text_length = len(content)
-    print(f"📄 Text file size: {text_length:,} characters")
-    
-    if text_length > 2000:
-        print(f"📚 Large file detected! Using smart chunking approach...")
-        success = convert_large_text_to_speech(
-            api_key=API_KEY,
-            model_id=MODEL_ID,
-            text_file_path=INPUT_TEXT_FILE,
-            output_file_path=OUTPUT_AUDIO_FILE,
-            chunk_size=CHUNK_SIZE
-        )
-    else:
-        print(f"📝 Small file, using standard conversion...")
-        success = convert_text_file_to_speech(
-            api_key=API_KEY,
-            model_id=MODEL_ID,
-            text_file_path=INPUT_TEXT_FILE,
-            output_file_path=OUTPUT_AUDIO_FILE
-        )
+    if os.path.getsize(INPUT_TEXT_FILE) == 0:
+        print("Error: Text file is empty!")
+        return
+    
+    # Map the file instead of reading it; its size is known without loading it
+    with open(INPUT_TEXT_FILE, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text_length = mm.size()
+        print(f"📄 Text file size: {text_length:,} bytes")
+        
+        if args.backend == "local":
+            print(f"🖥️  Using the local Piper backend...")
+            success = asyncio.run(convert_text_with_piper(
+                model_path=PIPER_MODEL_PATH,
+                text_data=mm,
+                output_file_path=output_file_path,
+                chunk_size=CHUNK_SIZE
+            ))
+        elif STREAM_TTS:
+            print(f"📡 Streaming text to Fish Audio over a websocket...")
+            success = asyncio.run(stream_text_to_speech(
+                api_key=API_KEY,
+                model_id=MODEL_ID,
+                text_data=mm,
+                output_file_path=output_file_path,
+                chunk_size=CHUNK_SIZE
+            ))
+        elif text_length > 2000:
+            print(f"📚 Large file detected! Using smart chunking approach...")
+            success = asyncio.run(convert_large_text_to_speech(
+                api_key=API_KEY,
+                model_id=MODEL_ID,
+                text_data=mm,
+                output_file_path=output_file_path,
+                chunk_size=CHUNK_SIZE
+            ))
+        else:
+            print(f"📝 Small file, using standard conversion...")
+            success = asyncio.run(convert_text_file_to_speech(
+                api_key=API_KEY,
+                model_id=MODEL_ID,
+                text_data=mm,
+                output_file_path=output_file_path
+            ))
     
     if success:
         print(f"\n🎉 Your text has been successfully converted to speech!")
-        print(f"🎧 You can now play the audio file: {OUTPUT_AUDIO_FILE}")
+        print(f"🎧 You can now play the audio file: {output_file_path}")
         print(f"⏱️  For 100K+ characters, this process may take several minutes...")
     else:
         print(f"\n❌ Conversion failed. Check the error messages above.")
 
 if __name__ == "__main__":
-    # First, install the required package if not already installed
+    # First, install HTTP/2 support for httpx if not already installed
     try:
-        import fish_audio_sdk
+        import h2
     except ImportError:
-        print("Installing Fish Audio SDK...")
-        os.system("pip install fish-audio-sdk")
-        import fish_audio_sdk
+        print("Installing HTTP/2 support for httpx...")
+        os.system('pip install "httpx[http2]"')
+        import h2
     
     main()